@@ -1,16 +1,31 @@
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 from werkzeug.utils import secure_filename
 import os
+import asyncio
+import functools
+import shutil
+import atexit
+import logging
+import struct
 from datetime import datetime
 from models import db, User, Document
 from record import save_audio
-from extraction import extract_features
+from audio_io import save_upload_as_wav, upload_duration
+from extraction import extract_features, save_features
+from extraction_kernels import framed_pitch, cosine_sim, audio_stats
 from testing import authenticate_voice
 import numpy as np
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 app = Flask(__name__)
 
+# Diagnostics of the voice pipeline go through module loggers; per-request
+# details are logged at DEBUG and only shown by the development server
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+logger = logging.getLogger(__name__)
+
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BASE_DIR, 'instance', 'database.db')
@@ -24,17 +39,125 @@ db.init_app(app)
 os.makedirs('data', exist_ok=True)
 os.makedirs('instance', exist_ok=True)
 
+# Compile the numba kernels up front so the first request doesn't pay for it
+framed_pitch(np.zeros(1, dtype=np.float32), 16000, 400, 160, 40, 200)
+cosine_sim(np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.float32), 0.0)
+audio_stats(np.zeros(1, dtype=np.float32), 100)
+
+# Use FFTW for scipy.fft when pyFFTW is installed, keeping its measured
+# plans (wisdom) across restarts
+FFTW_WISDOM_PATH = os.path.join(BASE_DIR, 'instance', 'fftw_wisdom.bin')
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+    import scipy.fft
+    
+    pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
+    pyfftw.interfaces.cache.enable()
+    scipy.fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+    
+    # Wisdom is one byte string per precision, stored length-prefixed
+    if os.path.exists(FFTW_WISDOM_PATH):
+        with open(FFTW_WISDOM_PATH, 'rb') as f:
+            data = f.read()
+        wisdom = []
+        pos = 0
+        try:
+            while pos < len(data):
+                (size,) = struct.unpack_from('<Q', data, pos)
+                pos += 8
+                wisdom.append(data[pos:pos + size])
+                pos += size
+            pyfftw.import_wisdom(tuple(wisdom))
+        except (struct.error, ValueError, TypeError):
+            pass  # Stale or damaged wisdom only costs replanning
+    
+    @atexit.register
+    def _save_fftw_wisdom():
+        with open(FFTW_WISDOM_PATH, 'wb') as f:
+            for part in pyfftw.export_wisdom():
+                f.write(struct.pack('<Q', len(part)))
+                f.write(part)
+except ImportError:
+    pass
+
+# Password hashing (argon2id)
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
 ALLOWED_EXTENSIONS = {'pdf', 'txt', 'doc', 'docx', 'png', 'jpg', 'jpeg'}
+DOCUMENTS_PER_PAGE = 25
+
+# Uploads below these limits are rejected before any decoding
+MIN_UPLOAD_BYTES = 2048
+MIN_AUDIO_SECONDS = 0.5
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def _verify_password(user, password):
+    """
+    Check a user's password
+
+    Legacy Werkzeug (PBKDF2/scrypt) hashes and argon2 hashes with outdated
+    parameters are rehashed with the current settings on success.
+    """
+    if user.password.startswith('$argon2'):
+        try:
+            password_hasher.verify(user.password, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        needs_rehash = password_hasher.check_needs_rehash(user.password)
+    else:
+        if not check_password_hash(user.password, password):
+            return False
+        needs_rehash = True
+    
+    if needs_rehash:
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+    return True
+
 def get_user_path(user_id, subdir=''):
     """Get path for user's data directory"""
-    path = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id), subdir)
+    return os.path.join(app.config['UPLOAD_FOLDER'], str(user_id), subdir)
+
+@functools.lru_cache(maxsize=4096)
+def ensure_user_path(user_id, subdir=''):
+    """Get path for user's data directory, creating it once per process"""
+    path = get_user_path(user_id, subdir)
     os.makedirs(path, exist_ok=True)
     return path
 
+def _stream_to(stream, path, chunk_size=1 << 20):
+    """Copy a raw request body to a file, returns the number of bytes written"""
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(stream, f, chunk_size)
+        return f.tell()
+
+def _check_upload_size():
+    """Return an error response if the declared upload size is too small"""
+    if request.content_length is not None and request.content_length < MIN_UPLOAD_BYTES:
+        return jsonify({'error': f'Recording too short, please record at least {MIN_AUDIO_SECONDS:g} seconds'}), 400
+    return None
+
+def _check_upload_duration(upload_path):
+    """Return an error response if the upload header says it is too short"""
+    duration = upload_duration(upload_path)
+    if duration is not None and duration < MIN_AUDIO_SECONDS:
+        return jsonify({'error': f'Recording too short ({duration:.2f}s), please record at least {MIN_AUDIO_SECONDS:g} seconds'}), 400
+    return None
+
+def _get_user_doc(doc_id, user_id):
+    """Get a document by id, or None if it doesn't exist or belongs to another user"""
+    document = db.session.get(Document, doc_id)
+    if document is None or document.user_id != user_id:
+        return None
+    return document
+
+def _features_path(user_id):
+    """Get path of user's template features"""
+    return os.path.join(get_user_path(user_id, 'features'), 'features.npy')
+
 @app.route('/')
 def index():
     if 'user_id' in session:
@@ -53,17 +176,17 @@ def signup():
         if User.query.filter_by(username=username).first():
             return jsonify({'error': 'Username already exists'}), 400
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         new_user = User(username=username, password=hashed_password)
         
         db.session.add(new_user)
         db.session.commit()
         
         # Create user directories
-        get_user_path(new_user.id, 'template')
-        get_user_path(new_user.id, 'features')
-        get_user_path(new_user.id, 'live')
-        get_user_path(new_user.id, 'documents')
+        ensure_user_path(new_user.id, 'template')
+        ensure_user_path(new_user.id, 'features')
+        ensure_user_path(new_user.id, 'live')
+        ensure_user_path(new_user.id, 'documents')
         
         return jsonify({'success': True, 'message': 'Account created successfully'})
     
@@ -77,7 +200,7 @@ def login():
         
         user = User.query.filter_by(username=username).first()
         
-        if user and check_password_hash(user.password, password):
+        if user and password and _verify_password(user, password):
             session['user_id'] = user.id
             session['username'] = user.username
             
@@ -111,86 +234,34 @@ def record_template():
     return render_template('record_template.html')
 
 @app.route('/save-template', methods=['POST'])
-def save_template():
+async def save_template():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    audio_data = request.files.get('audio')
-    if not audio_data:
-        return jsonify({'error': 'No audio data received'}), 400
+    error = _check_upload_size()
+    if error:
+        return error
     
     user_id = session['user_id']
     
-    # Save uploaded file temporarily with original extension
-    temp_input = os.path.join(get_user_path(user_id, 'template'), 'temp_upload.webm')
-    audio_data.save(temp_input)
-    
-    template_path = os.path.join(get_user_path(user_id, 'template'), 'template.wav')
+    # Stream the raw audio body to a temp file
+    temp_input = os.path.join(ensure_user_path(user_id, 'template'), 'temp_upload.webm')
+    template_path = os.path.join(ensure_user_path(user_id, 'template'), 'template.wav')
     
     try:
-        # Use FFmpeg to convert to WAV (most reliable method)
-        import subprocess
-        
-        # Check if ffmpeg is available
-        try:
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            # FFmpeg not available, try direct save
-            raise Exception("FFmpeg not found")
+        if not await asyncio.to_thread(_stream_to, request.stream, temp_input):
+            return jsonify({'error': 'No audio data received'}), 400
         
-        # Convert using FFmpeg
-        cmd = [
-            'ffmpeg',
-            '-i', temp_input,
-            '-acodec', 'pcm_s16le',  # 16-bit PCM
-            '-ar', '16000',           # 16kHz sample rate
-            '-ac', '1',               # Mono
-            '-y',                     # Overwrite output
-            template_path
-        ]
+        error = _check_upload_duration(temp_input)
+        if error:
+            return error
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            raise Exception(f"FFmpeg error: {result.stderr}")
-        
-        print(f"✅ Converted audio using FFmpeg")
-        
-    except Exception as e:
-        print(f"⚠️ FFmpeg failed: {e}, trying alternative method...")
-        
-        # Fallback: Try using soundfile directly (works for some formats)
-        try:
-            import soundfile as sf
-            data, samplerate = sf.read(temp_input)
-            
-            # Convert to mono if stereo
-            if len(data.shape) > 1:
-                data = np.mean(data, axis=1)
-            
-            # Simple resampling if needed
-            if samplerate != 16000:
-                from scipy.signal import resample
-                num_samples = int(len(data) * 16000 / samplerate)
-                data = resample(data, num_samples)
-                samplerate = 16000
-            
-            # Save as WAV
-            sf.write(template_path, data, samplerate, subtype='PCM_16')
-            print(f"✅ Converted audio using soundfile")
-            
-        except Exception as e2:
-            # Last resort: save as-is and hope it works
-            print(f"⚠️ Direct conversion failed: {e2}")
-            
-            # Just copy the file and rename to .wav
-            import shutil
-            shutil.copy(temp_input, template_path)
-            print(f"⚠️ Saved audio as-is (may need manual conversion)")
-    
-    # Clean up temp file
-    if os.path.exists(temp_input):
-        os.remove(temp_input)
+        # Decode upload to 16kHz mono WAV
+        await asyncio.to_thread(save_upload_as_wav, temp_input, template_path)
+    finally:
+        # Clean up temp file
+        if os.path.exists(temp_input):
+            os.remove(temp_input)
     
     # Verify the file exists and has content
     if not os.path.exists(template_path) or os.path.getsize(template_path) < 1000:
@@ -198,12 +269,11 @@ def save_template():
     
     # Extract and save features
     try:
-        features = extract_features(template_path)
-        features_path = os.path.join(get_user_path(user_id, 'features'), 'features.npy')
-        np.save(features_path, features)
-        print(f"✅ Extracted and saved features")
+        features = await asyncio.to_thread(extract_features, template_path)
+        save_features(os.path.join(ensure_user_path(user_id, 'features'), 'features.npy'), features)
+        logger.debug("✅ Extracted and saved features")
     except Exception as e:
-        print(f"❌ Feature extraction error: {e}")
+        logger.error("❌ Feature extraction error: %s", e)
         return jsonify({'error': f'Failed to extract features: {str(e)}'}), 400
     
     # Update user record
@@ -211,7 +281,7 @@ def save_template():
     user.has_template = True
     db.session.commit()
     
-    print(f"✅ Template saved successfully for user {user_id}")
+    logger.info("✅ Template saved successfully for user %s", user_id)
     return jsonify({'success': True, 'message': 'Voice template saved successfully'})
 
 
@@ -221,12 +291,20 @@ def dashboard():
         return redirect(url_for('login'))
     
     user = User.query.get(session['user_id'])
-    documents = Document.query.filter_by(user_id=session['user_id']).all()
+    
+    # Only load the columns the page renders, one page at a time
+    page = request.args.get('page', 1, type=int)
+    documents = Document.query.options(
+        db.load_only(Document.id, Document.filename, Document.is_locked,
+                     Document.uploaded_at, Document.unlock_count)
+    ).filter_by(user_id=session['user_id']).order_by(
+        Document.uploaded_at.desc()
+    ).paginate(page=page, per_page=DOCUMENTS_PER_PAGE, error_out=False)
     
     return render_template('dashboard.html', user=user, documents=documents)
 
 @app.route('/upload-document', methods=['POST'])
-def upload_document():
+async def upload_document():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
@@ -246,8 +324,8 @@ def upload_document():
     
     # Save file with locked_ prefix
     locked_filename = f"locked_{filename}"
-    filepath = os.path.join(get_user_path(user_id, 'documents'), locked_filename)
-    file.save(filepath)
+    filepath = os.path.join(ensure_user_path(user_id, 'documents'), locked_filename)
+    await asyncio.to_thread(file.save, filepath)
     
     # Create database record
     document = Document(
@@ -266,7 +344,7 @@ def unlock_page(doc_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    document = Document.query.filter_by(id=doc_id, user_id=session['user_id']).first()
+    document = _get_user_doc(doc_id, session['user_id'])
     
     if not document:
         return "Document not found", 404
@@ -274,68 +352,51 @@ def unlock_page(doc_id):
     return render_template('unlock.html', document=document)
 
 @app.route('/verify-voice/<int:doc_id>', methods=['POST'])
-def verify_voice(doc_id):
+async def verify_voice(doc_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    audio_data = request.files.get('audio')
-    if not audio_data:
-        return jsonify({'error': 'No audio data received'}), 400
+    error = _check_upload_size()
+    if error:
+        return error
     
     user_id = session['user_id']
-    document = Document.query.filter_by(id=doc_id, user_id=user_id).first()
+    document = _get_user_doc(doc_id, user_id)
     
     if not document:
         return jsonify({'error': 'Document not found'}), 404
     
-    # Save live audio with conversion
-    temp_live = os.path.join(get_user_path(user_id, 'live'), 'temp_live.webm')
-    live_path = os.path.join(get_user_path(user_id, 'live'), 'live.wav')
+    # Save live audio with conversion (same as template recording)
+    temp_live = os.path.join(ensure_user_path(user_id, 'live'), 'temp_live.webm')
+    live_path = os.path.join(ensure_user_path(user_id, 'live'), 'live.wav')
     
-    audio_data.save(temp_live)
-    
-    # Convert to WAV (same as template recording)
     try:
-        import subprocess
-        cmd = [
-            'ffmpeg',
-            '-i', temp_live,
-            '-acodec', 'pcm_s16le',
-            '-ar', '16000',
-            '-ac', '1',
-            '-y',
-            live_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        if not await asyncio.to_thread(_stream_to, request.stream, temp_live):
+            return jsonify({'error': 'No audio data received'}), 400
         
-        if result.returncode != 0:
-            # Fallback to soundfile
-            import soundfile as sf
-            data, sr = sf.read(temp_live)
-            if len(data.shape) > 1:
-                data = np.mean(data, axis=1)
-            if sr != 16000:
-                from scipy.signal import resample
-                data = resample(data, int(len(data) * 16000 / sr))
-            sf.write(live_path, data, 16000, subtype='PCM_16')
-    except Exception as e:
-        print(f"❌ Audio conversion error: {e}")
-        import shutil
-        shutil.copy(temp_live, live_path)
-    
+        error = _check_upload_duration(temp_live)
+        if error:
+            return error
+        
+        await asyncio.to_thread(save_upload_as_wav, temp_live, live_path)
     finally:
         if os.path.exists(temp_live):
             os.remove(temp_live)
     
     # Get template features path
-    features_path = os.path.join(get_user_path(user_id, 'features'), 'features.npy')
+    features_path = _features_path(user_id)
     
-    print(f"\n🔐 Authenticating user {user_id} for document {doc_id}")
-    print(f"  Live audio: {live_path} (exists: {os.path.exists(live_path)})")
-    print(f"  Template: {features_path} (exists: {os.path.exists(features_path)})")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "🔐 Authenticating user %s for document %s\n"
+            "  Live audio: %s (exists: %s)\n"
+            "  Template: %s (exists: %s)",
+            user_id, doc_id, live_path, os.path.exists(live_path),
+            features_path, os.path.exists(features_path)
+        )
     
     # Authenticate voice
-    result = authenticate_voice(live_path, features_path)
+    result = await asyncio.to_thread(authenticate_voice, live_path, features_path)
     
     if result['authenticated']:
         # Unlock document
@@ -372,7 +433,7 @@ def download_document(doc_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    document = Document.query.filter_by(id=doc_id, user_id=session['user_id']).first()
+    document = _get_user_doc(doc_id, session['user_id'])
     
     if not document:
         return "Document not found", 404
@@ -389,7 +450,7 @@ def delete_document(doc_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    document = Document.query.filter_by(id=doc_id, user_id=session['user_id']).first()
+    document = _get_user_doc(doc_id, session['user_id'])
     
     if not document:
         return jsonify({'error': 'Document not found'}), 404
@@ -415,13 +476,33 @@ def admin():
         return "Access denied", 403
     
     users = User.query.all()
-    all_documents = Document.query.all()
+    doc_counts = dict(
+        db.session.query(Document.user_id, db.func.count(Document.id)).group_by(Document.user_id).all()
+    )
+    locked_count = Document.query.filter_by(is_locked=True).count()
+    
+    page = request.args.get('page', 1, type=int)
+    documents = Document.query.options(
+        db.load_only(Document.id, Document.filename, Document.is_locked,
+                     Document.uploaded_at, Document.unlock_count),
+        db.joinedload(Document.owner).load_only(User.username)
+    ).order_by(Document.uploaded_at.desc()).paginate(
+        page=page, per_page=DOCUMENTS_PER_PAGE, error_out=False
+    )
     
-    return render_template('admin.html', users=users, documents=all_documents)
+    return render_template('admin.html', users=users, doc_counts=doc_counts,
+                           locked_count=locked_count, documents=documents)
 
 # Initialize database
 with app.app_context():
     db.create_all()
+    
+    # create_all() skips existing tables, so add any indexes they're missing
+    for table in (User.__table__, Document.__table__):
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
 
 if __name__ == '__main__':
+    for name in (__name__, 'extraction', 'testing'):
+        logging.getLogger(name).setLevel(logging.DEBUG)
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
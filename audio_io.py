@@ -0,0 +1,275 @@
+"""
+Audio Decoding Module
+Converts browser audio uploads into 16kHz mono WAV files
+"""
+
+import atexit
+import shutil
+import struct
+import subprocess
+import threading
+from math import gcd
+import av
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+TARGET_SAMPLE_RATE = 16000
+
+# Bytes read from the start of an upload when sniffing its header
+HEADER_SNIFF_BYTES = 4096
+
+# Matroska/WebM element IDs
+EBML_MAGIC = b'\x1aE\xdf\xa3'
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_CLUSTER = 0x1F43B675
+
+# FFmpeg reading the upload from stdin and writing raw 16-bit PCM to stdout
+FFMPEG_PIPE_CMD = [
+    'ffmpeg',
+    '-loglevel', 'error',
+    '-i', 'pipe:0',
+    '-f', 's16le',            # Raw 16-bit PCM
+    '-acodec', 'pcm_s16le',
+    '-ar', '16000',           # 16kHz sample rate
+    '-ac', '1',               # Mono
+    'pipe:1'
+]
+
+# One pre-started FFmpeg process kept waiting on stdin, so a conversion
+# doesn't pay for process startup and codec registration
+_ffmpeg_lock = threading.Lock()
+_ffmpeg_spare = None
+
+def decode_to_mono16k(source):
+    """
+    Decode an audio file in-process with PyAV
+
+    Args:
+        source: Path or binary file-like object of the audio file
+
+    Returns:
+        numpy float32 array of mono samples at 16kHz
+    """
+    container = av.open(source)
+    try:
+        # Browser recordings often carry no duration, so start with a
+        # 10 second buffer and grow it if needed
+        if container.duration:
+            est_samples = int(container.duration * TARGET_SAMPLE_RATE / av.time_base) + TARGET_SAMPLE_RATE
+        else:
+            est_samples = 10 * TARGET_SAMPLE_RATE
+
+        audio = np.empty(est_samples, dtype=np.float32)
+        offset = 0
+
+        resampler = av.AudioResampler(format='flt', layout='mono', rate=TARGET_SAMPLE_RATE)
+
+        def append(frames):
+            nonlocal audio, offset
+            for frame in frames:
+                samples = frame.to_ndarray().reshape(-1)
+                end = offset + len(samples)
+                if end > len(audio):
+                    audio = np.resize(audio, max(end, 2 * len(audio)))
+                audio[offset:end] = samples
+                offset = end
+
+        for frame in container.decode(audio=0):
+            append(resampler.resample(frame))
+
+        # Flush samples buffered inside the resampler
+        append(resampler.resample(None))
+    finally:
+        container.close()
+
+    return audio[:offset]
+
+def _read_vint(data, pos, keep_marker):
+    """Read an EBML variable-length integer, returns (value, new_pos, unknown_size)"""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Invalid EBML integer")
+
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+def webm_duration(header):
+    """
+    Read the duration of a WebM/Matroska file from its header bytes
+
+    Args:
+        header: First bytes of the file
+
+    Returns:
+        Duration in seconds, or None if the header doesn't carry one
+        (browser MediaRecorder output usually doesn't)
+    """
+    if not header.startswith(EBML_MAGIC):
+        return None
+
+    timecode_scale = 1000000  # Nanoseconds per tick (Matroska default)
+    duration = None
+    pos = 0
+
+    try:
+        while pos < len(header):
+            element_id, pos, _ = _read_vint(header, pos, keep_marker=True)
+            size, pos, unknown = _read_vint(header, pos, keep_marker=False)
+
+            # Step into Segment and Info, everything else is skipped whole
+            if element_id in (EBML_SEGMENT, EBML_INFO):
+                continue
+            if element_id == EBML_CLUSTER or unknown or pos + size > len(header):
+                break
+
+            if element_id == EBML_TIMECODE_SCALE:
+                timecode_scale = int.from_bytes(header[pos:pos + size], 'big')
+            elif element_id == EBML_DURATION:
+                duration = struct.unpack('>f' if size == 4 else '>d', header[pos:pos + size])[0]
+            pos += size
+    except (ValueError, IndexError, struct.error):
+        return None
+
+    if duration is None:
+        return None
+    return duration * timecode_scale / 1e9
+
+def upload_duration(path):
+    """
+    Get the duration of an uploaded WebM file from its header
+
+    Args:
+        path: Path to the uploaded file
+
+    Returns:
+        Duration in seconds, or None if unknown
+    """
+    with open(path, 'rb') as f:
+        return webm_duration(f.read(HEADER_SNIFF_BYTES))
+
+def _spawn_ffmpeg():
+    try:
+        return subprocess.Popen(FFMPEG_PIPE_CMD, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise Exception("FFmpeg not found")
+
+def _refill_ffmpeg_spare():
+    """Start a spare FFmpeg process unless another thread already did"""
+    global _ffmpeg_spare
+    try:
+        proc = _spawn_ffmpeg()
+    except Exception:
+        return
+
+    with _ffmpeg_lock:
+        if _ffmpeg_spare is None:
+            _ffmpeg_spare = proc
+            return
+    proc.kill()
+    proc.wait()
+
+def _take_ffmpeg():
+    """Hand out the pre-started FFmpeg process and start the next one in the background"""
+    global _ffmpeg_spare
+    with _ffmpeg_lock:
+        proc, _ffmpeg_spare = _ffmpeg_spare, None
+
+    if proc is None or proc.poll() is not None:
+        proc = _spawn_ffmpeg()
+
+    threading.Thread(target=_refill_ffmpeg_spare, name='ffmpeg-spare', daemon=True).start()
+    return proc
+
+@atexit.register
+def _kill_ffmpeg_spare():
+    with _ffmpeg_lock:
+        if _ffmpeg_spare is not None:
+            _ffmpeg_spare.kill()
+
+def convert_to_wav(input_path, output_path):
+    """
+    Convert an audio file to 16kHz mono 16-bit WAV using external tools
+
+    Tries FFmpeg first, then soundfile, and finally copies the file as-is.
+
+    Args:
+        input_path: Path to the source audio file
+        output_path: Path where to save the WAV file
+    """
+    try:
+        # Use FFmpeg to convert to WAV (most reliable method)
+        with open(input_path, 'rb') as f:
+            data = f.read()
+
+        proc = _take_ffmpeg()
+        stdout, stderr = proc.communicate(data)
+
+        if proc.returncode != 0:
+            raise Exception(f"FFmpeg error: {stderr.decode(errors='replace')}")
+
+        pcm = np.frombuffer(stdout, dtype='<i2')
+        sf.write(output_path, pcm, TARGET_SAMPLE_RATE, subtype='PCM_16')
+
+        print(f"✅ Converted audio using FFmpeg")
+
+    except Exception as e:
+        print(f"⚠️ FFmpeg failed: {e}, trying alternative method...")
+
+        # Fallback: Try using soundfile directly (works for some formats)
+        try:
+            data, samplerate = sf.read(input_path, dtype='float32')
+
+            # Convert to mono if stereo
+            if len(data.shape) > 1:
+                data = np.mean(data, axis=1)
+
+            # Simple resampling if needed
+            if samplerate != 16000:
+                g = gcd(samplerate, 16000)
+                data = resample_poly(data, 16000 // g, samplerate // g).astype(np.float32, copy=False)
+                samplerate = 16000
+
+            # Save as WAV
+            sf.write(output_path, data, samplerate, subtype='PCM_16')
+            print(f"✅ Converted audio using soundfile")
+
+        except Exception as e2:
+            # Last resort: save as-is and hope it works
+            print(f"⚠️ Direct conversion failed: {e2}")
+
+            # Just copy the file and rename to .wav
+            shutil.copy(input_path, output_path)
+            print(f"⚠️ Saved audio as-is (may need manual conversion)")
+
+def save_upload_as_wav(upload_path, output_path):
+    """
+    Save an uploaded audio file as a 16kHz mono 16-bit WAV
+
+    Decodes in-process with PyAV; only when that fails is the upload
+    handed to convert_to_wav.
+
+    Args:
+        upload_path: Path to the uploaded audio file
+        output_path: Path where to save the WAV file
+    """
+    try:
+        audio = decode_to_mono16k(upload_path)
+        sf.write(output_path, audio, TARGET_SAMPLE_RATE, subtype='PCM_16')
+        print(f"✅ Decoded audio using PyAV")
+    except Exception as e:
+        print(f"⚠️ PyAV decode failed: {e}, falling back to FFmpeg...")
+        convert_to_wav(upload_path, output_path)
@@ -0,0 +1,124 @@
+"""
+Similarity Batching
+Groups concurrent voice comparisons into a single vectorized computation
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+from extraction import compare_features
+
+class SimilarityBatcher:
+    """
+    Collects comparisons that arrive within a short window and scores
+    them together
+
+    Requests are queued from any thread; a background thread drains up to
+    max_batch items and computes all cosine similarities with one
+    vectorized pass. A request that finds nobody else queued is scored
+    right away; otherwise the batch keeps filling for at most max_wait
+    seconds after the first item.
+    """
+
+    def __init__(self, max_batch=64, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, live_features, template_features, template_norm=None):
+        """
+        Queue a comparison
+
+        Args:
+            live_features: Live feature vector
+            template_features: Template feature vector
+            template_norm: Precomputed norm of template_features (optional)
+
+        Returns:
+            concurrent.futures.Future resolving to the similarity (0-1)
+        """
+        self._ensure_started()
+        if template_norm is None:
+            template_norm = np.linalg.norm(template_features)
+
+        future = Future()
+        self._queue.put((live_features, template_features, template_norm, future))
+        return future
+
+    def similarity(self, live_features, template_features, template_norm=None):
+        """
+        Compare two feature vectors, batching with concurrent callers
+
+        Args:
+            live_features: Live feature vector
+            template_features: Template feature vector
+            template_norm: Precomputed norm of template_features (optional)
+
+        Returns:
+            Similarity score (0-1, higher is more similar)
+        """
+        if len(live_features) == 0 or len(live_features) != len(template_features):
+            # Let compare_features report and score invalid input
+            return compare_features(live_features, template_features, template_norm)
+
+        return self.submit(live_features, template_features, template_norm).result()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='similarity-batcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+
+                # Uncontended: don't make a lone request wait for company
+                timeout = deadline - time.monotonic()
+                if len(batch) == 1 or timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                sims = self._compute(batch)
+            except Exception as e:
+                print(f"❌ Error comparing feature batch: {e}")
+                sims = np.zeros(len(batch))
+
+            for item, sim in zip(batch, sims):
+                item[3].set_result(float(sim))
+
+    @staticmethod
+    def _compute(batch):
+        live = np.stack([item[0] for item in batch]).astype(np.float32, copy=False)
+        templates = np.stack([item[1] for item in batch]).astype(np.float32, copy=False)
+        template_norms = np.array([item[2] for item in batch], dtype=np.float32)
+
+        dots = np.einsum('ij,ij->i', live, templates)
+        norms = np.linalg.norm(live, axis=1) * template_norms
+
+        # Cosine similarity mapped to 0-1; zero-norm vectors score 0
+        sims = np.zeros(len(batch), dtype=np.float32)
+        valid = norms > 0
+        sims[valid] = 0.5 + 0.5 * dots[valid] / norms[valid]
+        return np.clip(sims, 0.0, 1.0)
+
+# Shared batcher used by the authentication pipeline
+similarity_batcher = SimilarityBatcher()
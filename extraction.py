@@ -3,44 +3,98 @@ Voice Feature Extraction
 Extracts MFCC and pitch features from audio files
 """
 
+import os
+import logging
 import numpy as np
+from math import gcd
 import soundfile as sf
-from python_speech_features import mfcc
-from scipy.signal import correlate
+from mfcc_kernel import mfcc_fast
+from extraction_kernels import framed_pitch, cosine_sim
 from scipy.fft import rfft, rfftfreq
+from scipy.signal import resample_poly
 import warnings
 warnings.filterwarnings('ignore')
 
-def extract_pitch(audio, sample_rate):
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 16384  # Samples per block for streamed statistics
+
+def _signal_stats(blocks, sample_rate):
     """
-    Extract pitch (fundamental frequency) using autocorrelation
+    Accumulate time-domain and spectral statistics over mono audio blocks
+    
+    The spectral centroid is taken from the magnitude spectra of the
+    blocks averaged Welch-style, so no full-signal FFT is needed.
+    
+    Args:
+        blocks: Iterable of mono float32 blocks (at most BLOCK_SIZE samples)
+        sample_rate: Sample rate in Hz
+    
+    Returns:
+        dict: {
+            'length': int,
+            'absmax': float,
+            'sum_sq': float,
+            'zero_crossings': int,
+            'spectral_centroid': float
+        }
     """
-    try:
-        # Normalize audio
-        if np.max(np.abs(audio)) > 0:
-            audio = audio / np.max(np.abs(audio))
-        else:
-            return 0
-        
-        # Apply autocorrelation
-        correlation = correlate(audio, audio, mode='full')
-        correlation = correlation[len(correlation)//2:]
-        
-        # Find peaks in autocorrelation
-        # Look for pitch in human voice range: 80-400 Hz
-        min_lag = int(sample_rate / 400)  # Max pitch
-        max_lag = int(sample_rate / 80)   # Min pitch
-        
-        if max_lag < len(correlation) and min_lag < max_lag:
-            peak_lag = np.argmax(correlation[min_lag:max_lag]) + min_lag
-            pitch = sample_rate / peak_lag if peak_lag > 0 else 0
-        else:
-            pitch = 0
-        
-        return pitch
-    except Exception as e:
-        print(f"⚠️ Pitch extraction warning: {e}")
-        return 0
+    length = 0
+    absmax = 0.0
+    sum_sq = 0.0
+    zero_crossings = 0
+    prev_negative = None
+    spectrum = np.zeros(BLOCK_SIZE // 2 + 1)
+    
+    for block in blocks:
+        length += len(block)
+        absmax = max(absmax, float(np.abs(block).max()))
+        sum_sq += float(np.dot(block, block))
+        
+        # Sign-bit changes, including across the block boundary
+        negative = np.signbit(block)
+        zero_crossings += np.count_nonzero(negative[1:] ^ negative[:-1])
+        if prev_negative is not None:
+            zero_crossings += int(prev_negative != negative[0])
+        prev_negative = negative[-1]
+        
+        spectrum += np.abs(rfft(block, n=BLOCK_SIZE, workers=-1))
+    
+    spectrum_sum = spectrum.sum()
+    if spectrum_sum > 0:
+        spectral_centroid = np.dot(rfftfreq(BLOCK_SIZE, 1/sample_rate), spectrum) / spectrum_sum
+    else:
+        spectral_centroid = 0
+    
+    return {
+        'length': length,
+        'absmax': absmax,
+        'sum_sq': sum_sq,
+        'zero_crossings': zero_crossings,
+        'spectral_centroid': spectral_centroid
+    }
+
+def _read_blocks(audio_path, audio):
+    """
+    Stream an audio file as mono float32 blocks, copying them into audio
+    
+    Args:
+        audio_path: Path to audio file
+        audio: Preallocated buffer that receives the whole signal
+    
+    Yields:
+        Mono blocks of at most BLOCK_SIZE samples
+    """
+    offset = 0
+    for block in sf.blocks(audio_path, blocksize=BLOCK_SIZE, dtype='float32', always_2d=True):
+        block = block[:, 0] if block.shape[1] == 1 else block.mean(axis=1)
+        audio[offset:offset + len(block)] = block
+        offset += len(block)
+        yield block
+
+def _array_blocks(audio):
+    """Split an in-memory signal into blocks of at most BLOCK_SIZE samples"""
+    return (audio[i:i + BLOCK_SIZE] for i in range(0, len(audio), BLOCK_SIZE))
 
 def extract_features(audio_path):
     """
@@ -53,187 +107,265 @@ def extract_features(audio_path):
         numpy array of features
     """
     try:
-        print(f"\n🔍 Extracting features from: {audio_path}")
-        
-        # Load audio file
-        audio, sample_rate = sf.read(audio_path)
-        print(f"  ✅ Loaded audio: {len(audio)} samples at {sample_rate}Hz")
-        
-        # Convert stereo to mono if needed
-        if len(audio.shape) > 1:
-            audio = np.mean(audio, axis=1)
-            print(f"  ✅ Converted to mono")
-        
-        # Check if audio is valid
-        if len(audio) == 0:
-            raise ValueError("Audio file is empty")
-        
-        if np.all(audio == 0):
-            raise ValueError("Audio contains only silence")
-        
-        # Normalize audio
-        if np.max(np.abs(audio)) > 0:
-            audio = audio / np.max(np.abs(audio))
+        logger.debug("🔍 Extracting features from: %s", audio_path)
         
-        # Resample to 16kHz if needed
-        if sample_rate != 16000:
-            print(f"  ⚠️ Resampling from {sample_rate}Hz to 16000Hz")
-            from scipy.signal import resample
-            duration = len(audio) / sample_rate
-            num_samples = int(duration * 16000)
-            audio = resample(audio, num_samples)
-            sample_rate = 16000
+        # Load audio file in blocks, accumulating energy/ZCR/centroid on the way
+        info = sf.info(audio_path)
+        sample_rate = info.samplerate
+        audio = np.empty(info.frames, dtype=np.float32)
+        stats = _signal_stats(_read_blocks(audio_path, audio), sample_rate)
+        audio = audio[:stats['length']]
+        logger.debug("  ✅ Loaded audio: %d samples at %dHz", len(audio), sample_rate)
         
-        # Check minimum duration (at least 0.5 seconds)
-        min_samples = int(0.5 * sample_rate)
-        if len(audio) < min_samples:
-            raise ValueError(f"Audio too short: {len(audio)/sample_rate:.2f}s (need at least 0.5s)")
+        return _features_from_audio(audio, sample_rate, stats)
         
-        print(f"  ✅ Audio duration: {len(audio)/sample_rate:.2f}s")
-        
-        # Extract MFCC features (13 coefficients)
-        try:
-            mfcc_features = mfcc(
-                audio,
-                samplerate=sample_rate,
-                numcep=13,
-                nfilt=26,
-                nfft=512,
-                lowfreq=0,
-                highfreq=None,
-                preemph=0.97,
-                ceplifter=22,
-                appendEnergy=True,
-                winfunc=np.hamming
-            )
-            
-            print(f"  ✅ Extracted MFCC: {mfcc_features.shape}")
-            
-            if mfcc_features.shape[0] == 0:
-                raise ValueError("No MFCC frames extracted")
-            
-        except Exception as e:
-            print(f"  ❌ MFCC extraction failed: {e}")
-            raise
-        
-        # Calculate statistics for MFCCs
-        mfcc_mean = np.mean(mfcc_features, axis=0)
-        mfcc_std = np.std(mfcc_features, axis=0)
-        mfcc_min = np.min(mfcc_features, axis=0)
-        mfcc_max = np.max(mfcc_features, axis=0)
-        
-        # Extract pitch features
-        frame_length = int(0.025 * sample_rate)  # 25ms frames
-        hop_length = int(0.010 * sample_rate)    # 10ms hop
-        
-        pitches = []
-        for i in range(0, len(audio) - frame_length, hop_length):
-            frame = audio[i:i + frame_length]
-            pitch = extract_pitch(frame, sample_rate)
-            if pitch > 0:  # Only keep valid pitches
-                pitches.append(pitch)
-        
-        if len(pitches) > 0:
-            pitch_mean = np.mean(pitches)
-            pitch_std = np.std(pitches)
-            print(f"  ✅ Pitch: mean={pitch_mean:.1f}Hz, std={pitch_std:.1f}Hz")
-        else:
-            pitch_mean = 150.0  # Default human voice pitch
-            pitch_std = 20.0
-            print(f"  ⚠️ No pitch detected, using defaults")
-        
-        # Additional spectral features
-        # Energy
-        energy = np.sum(audio ** 2) / len(audio)
-        
-        # Zero crossing rate
-        zero_crossings = np.sum(np.abs(np.diff(np.sign(audio)))) / (2 * len(audio))
-        
-        # Spectral centroid (using FFT)
-        fft = np.abs(rfft(audio))
-        freqs = rfftfreq(len(audio), 1/sample_rate)
-        spectral_centroid = np.sum(freqs * fft) / np.sum(fft) if np.sum(fft) > 0 else 0
-        
-        print(f"  ✅ Energy={energy:.6f}, ZCR={zero_crossings:.4f}, SC={spectral_centroid:.1f}Hz")
+    except Exception as e:
+        logger.exception("❌ Error extracting features from %s: %s", audio_path, e)
+        # Return zero features if extraction fails
+        return np.zeros(57, dtype=np.float32)  # 13*4 + 2 + 3 = 57 features
+
+def extract_features_from_array(audio, sample_rate):
+    """
+    Extract voice features from an already loaded signal
+    
+    Args:
+        audio: Mono float32 audio signal (normalized in place)
+        sample_rate: Sample rate in Hz
+    
+    Returns:
+        numpy array of features
+    """
+    try:
+        logger.debug("🔍 Extracting features from %d samples at %dHz", len(audio), sample_rate)
         
-        # Combine all features
-        features = np.concatenate([
-            mfcc_mean,      # 13 features
-            mfcc_std,       # 13 features
-            mfcc_min,       # 13 features
-            mfcc_max,       # 13 features
-            [pitch_mean, pitch_std],  # 2 features
-            [energy, zero_crossings, spectral_centroid]  # 3 features
-        ])
+        stats = _signal_stats(_array_blocks(audio), sample_rate)
+        return _features_from_audio(audio, sample_rate, stats)
         
-        # Check for NaN or Inf
-        if np.any(np.isnan(features)) or np.any(np.isinf(features)):
-            print(f"  ⚠️ Warning: Invalid values in features, replacing with zeros")
-            features = np.nan_to_num(features, nan=0.0, posinf=0.0, neginf=0.0)
+    except Exception as e:
+        logger.exception("❌ Error extracting features: %s", e)
+        # Return zero features if extraction fails
+        return np.zeros(57, dtype=np.float32)  # 13*4 + 2 + 3 = 57 features
+
+def _features_from_audio(audio, sample_rate, stats):
+    """
+    Compute the 57 features of a loaded signal
+    
+    Args:
+        audio: Mono float32 audio signal (normalized in place)
+        sample_rate: Sample rate in Hz
+        stats: Statistics of audio as returned by _signal_stats
+    
+    Returns:
+        numpy array of features
+    """
+    # Check if audio is valid
+    if len(audio) == 0:
+        raise ValueError("Audio file is empty")
+    
+    absmax = stats['absmax']
+    if absmax == 0:
+        raise ValueError("Audio contains only silence")
+    
+    # Normalize audio in place
+    audio *= 1.0 / absmax
+    
+    # Resample to 16kHz if needed
+    if sample_rate != 16000:
+        logger.debug("  ⚠️ Resampling from %dHz to 16000Hz", sample_rate)
+        g = gcd(sample_rate, 16000)
+        audio = resample_poly(audio, 16000 // g, sample_rate // g).astype(np.float32, copy=False)
+        sample_rate = 16000
+        
+        # Statistics have to be taken from the resampled signal
+        stats = _signal_stats(_array_blocks(audio), sample_rate)
+        absmax = 1.0
+    
+    # Check minimum duration (at least 0.5 seconds)
+    min_samples = int(0.5 * sample_rate)
+    if len(audio) < min_samples:
+        raise ValueError(f"Audio too short: {len(audio)/sample_rate:.2f}s (need at least 0.5s)")
+    
+    logger.debug("  ✅ Audio duration: %.2fs", len(audio) / sample_rate)
+    
+    # Extract MFCC features (13 coefficients)
+    try:
+        mfcc_features = mfcc_fast(audio)
         
-        print(f"✅ Successfully extracted {len(features)} features")
-        print(f"   Feature range: [{np.min(features):.3f}, {np.max(features):.3f}]")
-        print(f"   Feature mean: {np.mean(features):.3f}, std: {np.std(features):.3f}")
+        logger.debug("  ✅ Extracted MFCC: %s", mfcc_features.shape)
         
-        return features
+        if mfcc_features.shape[0] == 0:
+            raise ValueError("No MFCC frames extracted")
         
     except Exception as e:
-        print(f"❌ Error extracting features from {audio_path}: {e}")
-        import traceback
-        traceback.print_exc()
-        # Return zero features if extraction fails
-        return np.zeros(57)  # 13*4 + 2 + 3 = 57 features
+        logger.error("  ❌ MFCC extraction failed: %s", e)
+        raise
+    
+    # Calculate statistics for MFCCs
+    mfcc_mean = mfcc_features.mean(axis=0)
+    mfcc_centered = mfcc_features - mfcc_mean
+    mfcc_std = np.sqrt((mfcc_centered * mfcc_centered).mean(axis=0))
+    mfcc_min = np.minimum.reduce(mfcc_features, axis=0)
+    mfcc_max = np.maximum.reduce(mfcc_features, axis=0)
+    
+    # Extract pitch features
+    frame_length = int(0.025 * sample_rate)  # 25ms frames
+    hop_length = int(0.010 * sample_rate)    # 10ms hop
+    
+    # Look for pitch in human voice range: 80-400 Hz
+    min_lag = sample_rate // 400  # Max pitch
+    max_lag = sample_rate // 80   # Min pitch
+    
+    pitches = framed_pitch(audio, sample_rate, frame_length, hop_length, min_lag, max_lag)
+    pitches = pitches[pitches > 0]  # Only keep valid pitches
+    
+    if len(pitches) > 0:
+        pitch_mean = np.mean(pitches)
+        pitch_std = np.std(pitches)
+        logger.debug("  ✅ Pitch: mean=%.1fHz, std=%.1fHz", pitch_mean, pitch_std)
+    else:
+        pitch_mean = 150.0  # Default human voice pitch
+        pitch_std = 20.0
+        logger.debug("  ⚠️ No pitch detected, using defaults")
+    
+    # Additional spectral features (accumulated while reading)
+    # Energy of the normalized signal
+    energy = stats['sum_sq'] / (absmax * absmax) / len(audio)
+    
+    # Zero crossing rate (sign-bit changes between neighbouring samples)
+    zero_crossings = stats['zero_crossings'] / len(audio)
+    
+    # Spectral centroid (block-averaged FFT)
+    spectral_centroid = stats['spectral_centroid']
+    
+    logger.debug("  ✅ Energy=%.6f, ZCR=%.4f, SC=%.1fHz", energy, zero_crossings, spectral_centroid)
+    
+    # Combine all features
+    features = np.concatenate([
+        mfcc_mean,      # 13 features
+        mfcc_std,       # 13 features
+        mfcc_min,       # 13 features
+        mfcc_max,       # 13 features
+        [pitch_mean, pitch_std],  # 2 features
+        [energy, zero_crossings, spectral_centroid]  # 3 features
+    ]).astype(np.float32)
+    
+    # Check for NaN or Inf
+    if np.any(np.isnan(features)) or np.any(np.isinf(features)):
+        logger.warning("  ⚠️ Invalid values in features, replacing with zeros")
+        features = np.nan_to_num(features, nan=0.0, posinf=0.0, neginf=0.0)
+    
+    # The summary statistics cost a pass each, so only take them when logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "✅ Successfully extracted %d features\n"
+            "   Feature range: [%.3f, %.3f]\n"
+            "   Feature mean: %.3f, std: %.3f",
+            len(features), np.min(features), np.max(features),
+            np.mean(features), np.std(features)
+        )
+    
+    return features
 
-def compare_features(features1, features2):
+def compare_features(features1, features2, norm2=None):
     """
     Compare two feature vectors using cosine similarity
     
     Args:
         features1: First feature vector
         features2: Second feature vector
+        norm2: Precomputed norm of features2 (computed here if None)
     
     Returns:
         Similarity score (0-1, higher is more similar)
     """
     try:
-        # Check if features are valid
-        if len(features1) == 0 or len(features2) == 0:
-            print("⚠️ Empty feature vectors")
-            return 0.0
+        features1 = np.asarray(features1, dtype=np.float32)
+        features2 = np.asarray(features2, dtype=np.float32)
         
-        if np.all(features1 == 0) or np.all(features2 == 0):
-            print("⚠️ Zero feature vectors")
-            return 0.0
-        
-        # Normalize features
-        norm1 = np.linalg.norm(features1)
-        norm2 = np.linalg.norm(features2)
-        
-        if norm1 == 0 or norm2 == 0:
-            print("⚠️ Zero norm features")
+        # Check if features are valid
+        if len(features1) == 0 or len(features1) != len(features2):
+            logger.warning("⚠️ Empty or mismatched feature vectors")
             return 0.0
         
-        # Cosine similarity
-        similarity = np.dot(features1, features2) / (norm1 * norm2)
+        if norm2 is None:
+            norm2 = np.linalg.norm(features2)
         
-        # Convert to 0-1 range
-        similarity = (similarity + 1) / 2
-        
-        # Clip to valid range
-        similarity = np.clip(similarity, 0.0, 1.0)
-        
-        print(f"  Cosine similarity: {similarity:.3f}")
-        
-        return float(similarity)
+        return float(cosine_sim(features1, features2, norm2))
         
     except Exception as e:
-        print(f"❌ Error comparing features: {e}")
+        logger.error("❌ Error comparing features: %s", e)
         return 0.0
 
+def compare_templates(features, templates, norms=None):
+    """
+    Compare a feature vector against several templates at once
+    
+    Args:
+        features: Live feature vector
+        templates: Stacked template feature vectors, shape (K, D)
+        norms: Precomputed norms of the templates (computed here if None)
+    
+    Returns:
+        numpy array of K similarity scores (0-1, higher is more similar)
+    """
+    features = np.asarray(features, dtype=np.float32)
+    templates = np.asarray(templates, dtype=np.float32)
+    sims = np.zeros(len(templates), dtype=np.float32)
+    
+    # Check if features are valid
+    if len(features) == 0 or templates.ndim != 2 or templates.shape[1] != len(features):
+        logger.warning("⚠️ Empty or mismatched feature vectors")
+        return sims
+    
+    if norms is None:
+        norms = np.linalg.norm(templates, axis=1)
+    
+    # One matrix-vector product for all templates; zero-norm vectors score 0
+    denom = norms * np.linalg.norm(features)
+    valid = denom > 0
+    sims[valid] = 0.5 + 0.5 * (templates @ features)[valid] / denom[valid]
+    return np.clip(sims, 0.0, 1.0)
+
+def save_features(features_path, features):
+    """
+    Save a feature vector as float32
+    
+    The file is written next to its destination and moved into place, so
+    memory-mapped copies of the previous template stay valid.
+    
+    Args:
+        features_path: Path to the .npy file to write
+        features: Feature vector
+    """
+    tmp_path = features_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(features, dtype=np.float32))
+    os.replace(tmp_path, features_path)
+
+def load_features(features_path, mmap_mode=None):
+    """
+    Load a feature vector saved by save_features
+    
+    Files holding several stacked templates of shape (K, D) are returned
+    as such.
+    
+    Args:
+        features_path: Path to the .npy file
+        mmap_mode: Passed to np.load; float32 files are then
+            memory-mapped instead of read
+    
+    Returns:
+        float32 feature vector (or (K, D) array)
+    """
+    return np.load(features_path, mmap_mode=mmap_mode).astype(np.float32, copy=False)
+
 if __name__ == "__main__":
     # Test the feature extraction
     import sys
     
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.DEBUG)
+    
     if len(sys.argv) > 1:
         audio_file = sys.argv[1]
         features = extract_features(audio_file)
@@ -0,0 +1,196 @@
+"""
+Feature Extraction Kernels
+Numba-compiled inner loops used by the feature extraction pipeline
+"""
+
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+@njit(cache=True)
+def _num_frames(n, frame_len, hop):
+    """Number of frames starting at 0, hop, ... strictly before n - frame_len"""
+    if n > frame_len:
+        return (n - frame_len + hop - 1) // hop
+    return 0
+
+def _framed_pitch_loops(audio, sr, frame_len, hop, min_lag, max_lag):
+    """
+    Estimate pitch for every frame of the audio using autocorrelation
+
+    Only the lags in [min_lag, max_lag) are evaluated, which covers the
+    human voice range when called with sr//400 and sr//80.
+
+    Args:
+        audio: Mono audio signal
+        sr: Sample rate in Hz
+        frame_len: Frame length in samples
+        hop: Hop length in samples
+        min_lag: Smallest lag to search (highest pitch)
+        max_lag: Largest lag to search, exclusive (lowest pitch)
+
+    Returns:
+        float32 array with one pitch per frame (0 for silent frames)
+    """
+    n_frames = _num_frames(audio.shape[0], frame_len, hop)
+
+    pitches = np.zeros(n_frames, dtype=np.float32)
+    if min_lag < 1 or max_lag >= frame_len or min_lag >= max_lag:
+        return pitches
+
+    for f in range(n_frames):
+        i = f * hop
+
+        # Silent frames have no pitch
+        peak = 0.0
+        for k in range(frame_len):
+            peak = max(peak, abs(audio[i + k]))
+        if peak == 0.0:
+            continue
+
+        # Start from the first lag's score (fastmath assumes no infinities)
+        best_lag = min_lag
+        best_score = 0.0
+        for k in range(frame_len - min_lag):
+            best_score += audio[i + k] * audio[i + k + min_lag]
+
+        for lag in range(min_lag + 1, max_lag):
+            s = 0.0
+            for k in range(frame_len - lag):
+                s += audio[i + k] * audio[i + k + lag]
+            if s > best_score:
+                best_score = s
+                best_lag = lag
+
+        pitches[f] = sr / best_lag
+
+    return pitches
+
+def _framed_pitch_vectorized(audio, sr, frame_len, hop, min_lag, max_lag):
+    """
+    NumPy version of framed_pitch, used when Numba is not installed
+
+    Frames are strided views of the audio, and the autocorrelation is
+    computed for all frames at once, one lag at a time.
+    """
+    n_frames = _num_frames(len(audio), frame_len, hop)
+
+    pitches = np.zeros(n_frames, dtype=np.float32)
+    if n_frames == 0 or min_lag < 1 or max_lag >= frame_len or min_lag >= max_lag:
+        return pitches
+
+    frames = sliding_window_view(audio, frame_len)[::hop][:n_frames]
+    lags = np.arange(min_lag, max_lag)
+    autocorr = np.stack(
+        [np.einsum('ij,ij->i', frames[:, :-lag], frames[:, lag:]) for lag in lags],
+        axis=1
+    )
+
+    pitches[:] = sr / lags[autocorr.argmax(axis=1)]
+
+    # Silent frames have no pitch
+    pitches[np.abs(frames).max(axis=1) == 0] = 0
+    return pitches
+
+if NUMBA_AVAILABLE:
+    # Serial on purpose: callers run on request threads, and Numba's default
+    # workqueue threading layer aborts on concurrent parallel calls
+    framed_pitch = njit(fastmath=True, cache=True)(_framed_pitch_loops)
+else:
+    framed_pitch = _framed_pitch_vectorized
+
+def _audio_stats_loops(audio, tail_len):
+    """
+    Collect the time-domain statistics used by spoof detection in one pass
+
+    Args:
+        audio: Mono float32 audio signal (non-empty)
+        tail_len: Number of trailing samples used for the noise estimate
+
+    Returns:
+        tuple: (peak absolute value, number of sign-bit changes between
+        neighbouring samples, min, max, sum of squares, variance of the
+        tail)
+    """
+    n = audio.shape[0]
+    bits = audio.view(np.uint32)
+    tail_start = max(n - tail_len, 0)
+
+    peak = 0.0
+    amin = audio[0]
+    amax = audio[0]
+    sum_sq = 0.0
+    tail_mean = 0.0
+    tail_m2 = 0.0
+    crossings = 0
+
+    for i in range(n):
+        x = audio[i]
+        peak = max(peak, abs(x))
+        amin = min(amin, x)
+        amax = max(amax, x)
+        sum_sq += x * x
+
+        if i > 0:
+            crossings += (bits[i - 1] ^ bits[i]) >> 31
+
+        # Welford's update, avoiding the cancellation of E[x^2] - E[x]^2
+        if i >= tail_start:
+            k = i - tail_start + 1
+            delta = x - tail_mean
+            tail_mean += delta / k
+            tail_m2 += delta * (x - tail_mean)
+
+    return peak, crossings, amin, amax, sum_sq, tail_m2 / (n - tail_start)
+
+def _audio_stats_vectorized(audio, tail_len):
+    """NumPy version of audio_stats, used when Numba is not installed"""
+    bits = audio.view(np.uint32)
+    tail = audio[-tail_len:]
+    return (
+        float(np.abs(audio).max()),
+        int(np.count_nonzero((bits[:-1] ^ bits[1:]) >> 31)),
+        float(audio.min()),
+        float(audio.max()),
+        float(np.dot(audio, audio)),
+        float(tail.var(dtype=np.float64))
+    )
+
+if NUMBA_AVAILABLE:
+    audio_stats = njit(fastmath=True, cache=True)(_audio_stats_loops)
+else:
+    audio_stats = _audio_stats_vectorized
+
+@njit(fastmath=True, cache=True)
+def cosine_sim(a, b, nb):
+    """
+    Cosine similarity of two feature vectors mapped to the 0-1 range
+
+    Args:
+        a: Live feature vector
+        b: Template feature vector (same length as a)
+        nb: Precomputed norm of b
+
+    Returns:
+        Similarity score (0-1, 0 if either vector has zero norm)
+    """
+    na2 = 0.0
+    dot = 0.0
+    for i in range(a.shape[0]):
+        na2 += a[i] * a[i]
+        dot += a[i] * b[i]
+
+    if na2 == 0.0 or nb == 0.0:
+        return 0.0
+
+    similarity = 0.5 + 0.5 * dot / (math.sqrt(na2) * nb)
+    return min(max(similarity, 0.0), 1.0)
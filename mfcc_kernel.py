@@ -0,0 +1,69 @@
+"""
+MFCC Kernel
+Computes MFCCs with filterbank, DCT and window matrices built once at import
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from python_speech_features import get_filterbanks
+from scipy.fft import rfft, dct
+
+SAMPLE_RATE = 16000
+FRAME_LEN = 400     # 25ms frames
+FRAME_STEP = 160    # 10ms hop
+NFFT = 512
+NFILT = 26
+NUMCEP = 13
+PREEMPH = 0.97
+CEPLIFTER = 22
+
+# Same parameters as python_speech_features.mfcc(samplerate=16000, nfilt=26,
+# nfft=512, lowfreq=0, highfreq=None, winfunc=np.hamming)
+_MEL_FB = get_filterbanks(NFILT, NFFT, SAMPLE_RATE, 0, SAMPLE_RATE / 2)
+_DCT = dct(np.eye(NFILT), type=2, axis=0, norm='ortho')[:NUMCEP]
+_HAMMING = np.hamming(FRAME_LEN).astype(np.float32)
+_LIFTER = 1 + (CEPLIFTER / 2.) * np.sin(np.pi * np.arange(NUMCEP) / CEPLIFTER)
+_EPS = np.finfo(float).eps
+
+def mfcc_fast(audio):
+    """
+    Compute 13 MFCCs per frame for 16kHz audio
+
+    Matches python_speech_features.mfcc with the settings used by
+    extract_features (preemphasis, liftering and log frame energy in
+    the first coefficient).
+
+    Args:
+        audio: Mono audio signal at 16kHz
+
+    Returns:
+        numpy array of shape (num_frames, 13)
+    """
+    # Preemphasis
+    signal = np.empty_like(audio)
+    signal[0] = audio[0]
+    np.subtract(audio[1:], PREEMPH * audio[:-1], out=signal[1:])
+
+    # Zero-pad so the last partial frame is kept
+    if len(signal) <= FRAME_LEN:
+        num_frames = 1
+    else:
+        num_frames = 1 + int(np.ceil((len(signal) - FRAME_LEN) / FRAME_STEP))
+    pad_len = (num_frames - 1) * FRAME_STEP + FRAME_LEN
+    signal = np.concatenate((signal, np.zeros(pad_len - len(signal), dtype=signal.dtype)))
+
+    frames = sliding_window_view(signal, FRAME_LEN)[::FRAME_STEP] * _HAMMING
+
+    # Power spectrum and frame energy
+    pspec = np.abs(rfft(frames, n=NFFT, axis=1, workers=-1)) ** 2 / NFFT
+    energy = pspec.sum(axis=1)
+    energy[energy == 0] = _EPS
+
+    # Mel filterbank energies -> cepstrum
+    feat = pspec @ _MEL_FB.T
+    feat[feat == 0] = _EPS
+    feat = np.log(feat) @ _DCT.T
+    feat *= _LIFTER
+    feat[:, 0] = np.log(energy)
+
+    return feat
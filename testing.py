@@ -3,26 +3,241 @@ Voice Authentication and Spoof Detection
 Authenticates users based on voice features and detects replay attacks
 """
 
+import functools
+import logging
 import numpy as np
 import soundfile as sf
-from scipy.signal import stft
-from extraction import extract_features, compare_features
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import get_window
+from scipy.fft import rfft
+from extraction import extract_features, extract_features_from_array, load_features, compare_templates
+from extraction_kernels import audio_stats
+from batching import similarity_batcher
 import os
+
+try:
+    import cupy as cp
+    CUPY_AVAILABLE = True
+except ImportError:
+    cp = None
+    CUPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
 # Authentication thresholds
 SPOOF_THRESHOLD = 0.5   # Confidence that audio is live (0-1)
 MATCH_THRESHOLD = 0.7   # Similarity threshold for voice matching (0-1)
 
+# Weights of the spoof detection feature scores (sum to 1)
+SPOOF_WEIGHTS = {
+    'zcr': 0.15,
+    'hf': 0.25,
+    'flux': 0.30,
+    'dr': 0.15,
+    'snr': 0.15
+}
+
+# Spoof detection STFT frame length, and its Hann window with
+# scipy.signal.stft's scaling, built once
+STFT_NPERSEG = 256
+_HANN_WINDOW = get_window('hann', STFT_NPERSEG)
+_HANN_WINDOW = (_HANN_WINDOW / _HANN_WINDOW.sum()).astype(np.float32)
+
+def _stft(audio):
+    """
+    One-sided STFT of a real signal, framed with strides and transformed with rfft
+    
+    Uses the same Hann window, 50% overlap, zero-padded edges and
+    scaling as scipy.signal.stft(audio, nperseg=STFT_NPERSEG).
+    
+    Args:
+        audio: Mono float32 audio signal
+    
+    Returns:
+        Complex array of shape (STFT_NPERSEG // 2 + 1, num_frames)
+    """
+    hop = STFT_NPERSEG // 2
+    
+    # Zero-padded copy of the signal, built in a single buffer
+    padded = np.zeros(2 * hop + len(audio) + (-len(audio)) % hop, dtype=np.float32)
+    padded[hop:hop + len(audio)] = audio
+    
+    # Window the strided frames into one buffer that the FFT may overwrite
+    frame_view = sliding_window_view(padded, STFT_NPERSEG)[::hop]
+    frames = np.multiply(frame_view, _HANN_WINDOW, out=np.empty(frame_view.shape, dtype=np.float32))
+    return rfft(frames, axis=1, overwrite_x=True, workers=-1).T
+
+def load_template(template_features_path):
+    """
+    Load template features together with their norm
+    
+    Results are cached by path and mtime, so re-enrolling a template
+    invalidates the cached entry automatically.
+    
+    Args:
+        template_features_path: Path to stored template features, either
+            one vector or K stacked vectors of shape (K, D)
+    
+    Returns:
+        (features, norm) tuple; features is a read-only float32 array,
+        norm is a float (or an array of K norms for stacked templates)
+    """
+    return _load_template(template_features_path, os.path.getmtime(template_features_path))
+
+@functools.lru_cache(maxsize=1024)
+def _load_template(template_features_path, mtime):
+    """Cached part of load_template; mtime only serves as part of the key"""
+    # Large stacked float32 templates are mapped from the page cache; a
+    # single vector is copied out so the cache doesn't hold its file open
+    features = load_features(template_features_path, mmap_mode='r')
+    if features.ndim == 1:
+        features = np.array(features)
+    features.flags.writeable = False
+    norm = np.linalg.norm(features, axis=-1)
+    if features.ndim == 1:
+        norm = float(norm)
+    return features, norm
+
+def _load_audio(audio_path):
+    """Read an audio file as a mono float32 signal, returns (audio, sample_rate)"""
+    audio, sample_rate = sf.read(audio_path, dtype='float32')
+    
+    # Convert stereo to mono if needed
+    if len(audio.shape) > 1:
+        audio = np.mean(audio, axis=1)
+    
+    return audio, sample_rate
+
 def detect_spoof(audio_path):
     """
     Detect if audio is a replay/spoof attack
     
+    Args:
+        audio_path: Path to audio file to check
+    
+    Returns:
+        dict: {
+            'is_live': bool,
+            'confidence': float (0-1)
+        }
+    """
+    try:
+        audio, sample_rate = _load_audio(audio_path)
+    except Exception as e:
+        logger.error("❌ Error in spoof detection: %s", e)
+        return {
+            'is_live': False,
+            'confidence': 0.0
+        }
+    
+    return detect_spoof_from_array(audio, sample_rate)
+
+def _time_domain_scores(length, scale, crossings, audio_min, audio_max, sum_sq, tail_var):
+    """
+    Score the time-domain spoofing features from audio_stats output
+    
+    Args:
+        length: Number of samples
+        scale: Normalization factor (1 / peak)
+        crossings, audio_min, audio_max, sum_sq, tail_var: Statistics of
+            the unnormalized signal as returned by audio_stats
+    
+    Returns:
+        (zcr_score, dr_score, snr_score) tuple, each in 0-1
+    """
+    # Feature 1: Zero crossing rate (recordings tend to have lower ZCR),
+    # counted as sign-bit changes like in extract_features
+    zero_crossings = crossings / length
+    zcr_score = min(zero_crossings * 100, 1.0)  # Higher is better
+    
+    # Feature 4: Dynamic range
+    # Recordings often have compressed dynamic range
+    dynamic_range = (audio_max - audio_min) * scale
+    dr_score = min(dynamic_range * 2, 1.0)
+    
+    # Feature 5: Signal-to-noise ratio estimate
+    # Calculate using high-frequency content
+    signal_power = sum_sq / length * scale * scale
+    if signal_power > 0:
+        noise_power = tail_var * scale * scale
+        snr_estimate = 10 * np.log10(signal_power / (1e-10 + noise_power))
+        snr_score = min(max(snr_estimate / 40, 0), 1.0)
+    else:
+        snr_score = 0.5
+    
+    return zcr_score, dr_score, snr_score
+
+def _spectral_scores(low_freq_energy, total_energy, avg_flux):
+    """
+    Score the spectral spoofing features
+    
+    Args:
+        low_freq_energy: STFT energy of the lower half of the bins
+        total_energy: Total STFT energy
+        avg_flux: Mean spectral flux between frames (None for a single frame)
+    
+    Returns:
+        (hf_score, flux_score) tuple, each in 0-1
+    """
+    # Feature 2: High frequency energy ratio
+    # Live recordings have more high-frequency content
+    if total_energy > 0:
+        hf_ratio = (total_energy - low_freq_energy) / total_energy
+    else:
+        hf_ratio = 0
+    
+    hf_score = min(hf_ratio * 3, 1.0)  # Higher is better
+    
+    # Feature 3: Spectral flux (variation in spectrum over time)
+    # Live audio has more variation
+    if avg_flux is not None:
+        flux_score = min(avg_flux * 0.01, 1.0)  # Normalize
+    else:
+        flux_score = 0.5
+    
+    return hf_score, flux_score
+
+def _spoof_result(zcr_score, hf_score, flux_score, dr_score, snr_score):
+    """Combine the five feature scores into the detect_spoof result"""
+    confidence = (
+        SPOOF_WEIGHTS['zcr'] * zcr_score +
+        SPOOF_WEIGHTS['dr'] * dr_score +
+        SPOOF_WEIGHTS['snr'] * snr_score +
+        SPOOF_WEIGHTS['hf'] * hf_score +
+        SPOOF_WEIGHTS['flux'] * flux_score
+    )
+    
+    is_live = confidence >= SPOOF_THRESHOLD
+    
+    logger.debug(
+        "🔍 Spoof Detection Scores:\n"
+        "  - Zero Crossing Rate: %.3f\n"
+        "  - High Freq Ratio: %.3f\n"
+        "  - Spectral Flux: %.3f\n"
+        "  - Dynamic Range: %.3f\n"
+        "  - SNR Estimate: %.3f\n"
+        "  → Overall Confidence: %.3f (%s)",
+        zcr_score, hf_score, flux_score, dr_score, snr_score,
+        confidence, 'LIVE' if is_live else 'SPOOF'
+    )
+    
+    return {
+        'is_live': is_live,
+        'confidence': float(confidence)
+    }
+
+def detect_spoof_from_array(audio, sample_rate):
+    """
+    Detect if an already loaded signal is a replay/spoof attack
+    
     Checks for:
     - Spectral characteristics typical of recordings
     - Audio quality artifacts
     - Frequency distribution anomalies
     
     Args:
-        audio_path: Path to audio file to check
+        audio: Mono float32 audio signal (normalized in place)
+        sample_rate: Sample rate in Hz
     
     Returns:
         dict: {
@@ -31,110 +246,171 @@ def detect_spoof(audio_path):
         }
     """
     try:
-        # Load audio
-        audio, sample_rate = sf.read(audio_path)
-        
-        # Convert stereo to mono if needed
-        if len(audio.shape) > 1:
-            audio = np.mean(audio, axis=1)
-        
-        # Normalize
-        audio = audio / np.max(np.abs(audio)) if np.max(np.abs(audio)) > 0 else audio
-        
-        # Feature 1: Zero crossing rate (recordings tend to have lower ZCR)
-        zero_crossings = np.sum(np.abs(np.diff(np.sign(audio)))) / (2 * len(audio))
-        zcr_score = min(zero_crossings * 100, 1.0)  # Higher is better
+        if len(audio) == 0:
+            raise ValueError("Audio file is empty")
         
-        # Feature 2: High frequency energy ratio
-        # Live recordings have more high-frequency content
-        f, t, Zxx = stft(audio, fs=sample_rate, nperseg=256)
-        power_spectrum = np.abs(Zxx) ** 2
+        # Peak, zero crossings, range and power in a single pass
+        peak, crossings, audio_min, audio_max, sum_sq, tail_var = audio_stats(audio, 100)
         
-        # Split spectrum into low and high frequency bands
-        freq_split = len(f) // 2
-        low_freq_energy = np.sum(power_spectrum[:freq_split, :])
-        high_freq_energy = np.sum(power_spectrum[freq_split:, :])
-        
-        if low_freq_energy + high_freq_energy > 0:
-            hf_ratio = high_freq_energy / (low_freq_energy + high_freq_energy)
-        else:
-            hf_ratio = 0
-        
-        hf_score = min(hf_ratio * 3, 1.0)  # Higher is better
-        
-        # Feature 3: Spectral flux (variation in spectrum over time)
-        # Live audio has more variation
-        spectral_flux = []
-        for i in range(1, Zxx.shape[1]):
-            flux = np.sum((np.abs(Zxx[:, i]) - np.abs(Zxx[:, i-1])) ** 2)
-            spectral_flux.append(flux)
-        
-        if len(spectral_flux) > 0:
-            avg_flux = np.mean(spectral_flux)
-            flux_score = min(avg_flux * 0.01, 1.0)  # Normalize
-        else:
-            flux_score = 0.5
-        
-        # Feature 4: Dynamic range
-        # Recordings often have compressed dynamic range
-        dynamic_range = np.max(audio) - np.min(audio)
-        dr_score = min(dynamic_range * 2, 1.0)
-        
-        # Feature 5: Signal-to-noise ratio estimate
-        # Calculate using high-frequency content
-        signal_power = np.mean(audio ** 2)
-        if signal_power > 0:
-            snr_estimate = 10 * np.log10(signal_power / (1e-10 + np.std(audio[-100:])**2))
-            snr_score = min(max(snr_estimate / 40, 0), 1.0)
-        else:
-            snr_score = 0.5
+        # Normalize in place (the statistics above are rescaled to match)
+        scale = 1.0 / peak if peak > 0 else 1.0
+        if peak > 0:
+            np.multiply(audio, scale, out=audio)
         
-        # Combine scores with weights
-        weights = {
-            'zcr': 0.15,
-            'hf': 0.25,
-            'flux': 0.30,
-            'dr': 0.15,
-            'snr': 0.15
-        }
-        
-        confidence = (
-            weights['zcr'] * zcr_score +
-            weights['hf'] * hf_score +
-            weights['flux'] * flux_score +
-            weights['dr'] * dr_score +
-            weights['snr'] * snr_score
+        zcr_score, dr_score, snr_score = _time_domain_scores(
+            len(audio), scale, crossings, audio_min, audio_max, sum_sq, tail_var
         )
         
-        is_live = confidence >= SPOOF_THRESHOLD
+        # Magnitudes are shared by the band energies and the spectral flux
+        Zxx = _stft(audio)
+        mag = np.abs(Zxx)
+        power_spectrum = np.square(mag)
         
-        print(f"🔍 Spoof Detection Scores:")
-        print(f"  - Zero Crossing Rate: {zcr_score:.3f}")
-        print(f"  - High Freq Ratio: {hf_score:.3f}")
-        print(f"  - Spectral Flux: {flux_score:.3f}")
-        print(f"  - Dynamic Range: {dr_score:.3f}")
-        print(f"  - SNR Estimate: {snr_score:.3f}")
-        print(f"  → Overall Confidence: {confidence:.3f} ({'LIVE' if is_live else 'SPOOF'})")
+        # Split spectrum into low and high frequency bands; the one-sided
+        # spectrum holds all the energy, so only the low band is summed apart
+        freq_split = Zxx.shape[0] // 2
+        bin_energy = power_spectrum.sum(axis=1)
+        total_energy = bin_energy.sum()
+        low_freq_energy = bin_energy[:freq_split].sum()
         
-        return {
-            'is_live': is_live,
-            'confidence': float(confidence)
-        }
+        diffs = np.diff(mag, axis=1)
+        spectral_flux = np.einsum('ij,ij->j', diffs, diffs)
+        avg_flux = np.mean(spectral_flux) if spectral_flux.size > 0 else None
+        
+        hf_score, flux_score = _spectral_scores(low_freq_energy, total_energy, avg_flux)
+        return _spoof_result(zcr_score, hf_score, flux_score, dr_score, snr_score)
         
     except Exception as e:
-        print(f"❌ Error in spoof detection: {e}")
+        logger.error("❌ Error in spoof detection: %s", e)
         return {
             'is_live': False,
             'confidence': 0.0
         }
 
+def detect_spoof_gpu(audio_batch, sample_rate):
+    """
+    Detect replay/spoof attacks for several signals at once on the GPU
+    
+    The signals are zero-padded into one (B, T) array, and statistics,
+    STFT and spectral reductions run batched with CuPy; only a few
+    scalars per signal are copied back. Scores match
+    detect_spoof_from_array, but every signal gets the full STFT. Falls
+    back to detect_spoof_from_array per signal when CuPy isn't installed
+    or the GPU computation fails.
+    
+    Args:
+        audio_batch: List of mono float32 audio signals
+        sample_rate: Sample rate in Hz
+    
+    Returns:
+        List of detect_spoof result dicts, one per signal
+    """
+    audio_batch = [np.asarray(audio, dtype=np.float32) for audio in audio_batch]
+    
+    if CUPY_AVAILABLE and audio_batch and all(len(audio) > 0 for audio in audio_batch):
+        try:
+            return _detect_spoof_cupy(audio_batch)
+        except Exception as e:
+            logger.error("❌ GPU spoof detection failed, using CPU: %s", e)
+    
+    return [detect_spoof_from_array(audio.copy(), sample_rate) for audio in audio_batch]
+
+def _detect_spoof_cupy(audio_batch):
+    """Batched CuPy implementation of detect_spoof_gpu"""
+    hop = STFT_NPERSEG // 2
+    lengths = np.array([len(audio) for audio in audio_batch])
+    
+    # Zero-padded rows laid out like _stft's padded signal
+    num_frames = -(-lengths // hop) + 1
+    padded = np.zeros((len(audio_batch), (num_frames.max() + 1) * hop), dtype=np.float32)
+    for row, audio in zip(padded, audio_batch):
+        row[hop:hop + len(audio)] = audio
+    
+    x = cp.asarray(padded)
+    n = cp.asarray(lengths)
+    signal = x[:, hop:hop + lengths.max()]
+    valid = cp.arange(signal.shape[1])[None, :] < n[:, None]
+    
+    # Time-domain statistics of the unnormalized signals
+    peak = cp.abs(signal).max(axis=1)
+    audio_min = cp.where(valid, signal, cp.inf).min(axis=1)
+    audio_max = cp.where(valid, signal, -cp.inf).max(axis=1)
+    sum_sq = cp.square(signal).sum(axis=1, dtype=cp.float64)
+    
+    bits = signal.view(cp.uint32)
+    crossings = cp.count_nonzero(((bits[:, :-1] ^ bits[:, 1:]) >> 31).astype(bool) & valid[:, 1:], axis=1)
+    
+    tail_idx = cp.maximum(n - 100, 0)[:, None] + cp.arange(100)[None, :]
+    tail_valid = tail_idx < n[:, None]
+    tail = cp.where(tail_valid, cp.take_along_axis(signal, cp.minimum(tail_idx, signal.shape[1] - 1), axis=1), 0)
+    tail_n = cp.minimum(n, 100)
+    tail_mean = tail.sum(axis=1, dtype=cp.float64) / tail_n
+    tail_var = cp.where(tail_valid, cp.square(tail - tail_mean[:, None]), 0).sum(axis=1) / tail_n
+    
+    # Normalize, frame and transform all signals together
+    scale = cp.where(peak > 0, 1.0 / peak, 1.0).astype(cp.float32)
+    x *= scale[:, None]
+    frames = cp.lib.stride_tricks.as_strided(
+        x,
+        shape=(x.shape[0], int(num_frames.max()), STFT_NPERSEG),
+        strides=(x.strides[0], hop * x.itemsize, x.itemsize)
+    )
+    mag = cp.abs(cp.fft.rfft(frames * cp.asarray(_HANN_WINDOW), axis=-1))
+    
+    # Frames past a signal's end are all zeros, so they add no energy
+    bin_energy = cp.square(mag).sum(axis=1)
+    total_energy = bin_energy.sum(axis=1)
+    low_freq_energy = bin_energy[:, :mag.shape[2] // 2].sum(axis=1)
+    
+    # ...but the step into them must not count as flux
+    diffs = cp.diff(mag, axis=1)
+    flux = cp.square(diffs).sum(axis=2)
+    flux_valid = cp.arange(flux.shape[1])[None, :] < (cp.asarray(num_frames) - 1)[:, None]
+    flux_sum = cp.where(flux_valid, flux, 0).sum(axis=1)
+    
+    stats = cp.asnumpy(cp.stack([
+        scale, crossings, audio_min, audio_max, sum_sq, tail_var,
+        low_freq_energy, total_energy, flux_sum
+    ], axis=1).astype(cp.float64))
+    
+    results = []
+    for length, frames_count, row in zip(lengths, num_frames, stats):
+        scale, crossings, audio_min, audio_max, sum_sq, tail_var, low, total, flux_sum = row
+        zcr_score, dr_score, snr_score = _time_domain_scores(
+            length, scale, crossings, audio_min, audio_max, sum_sq, tail_var
+        )
+        avg_flux = flux_sum / (frames_count - 1) if frames_count > 1 else None
+        hf_score, flux_score = _spectral_scores(low, total, avg_flux)
+        results.append(_spoof_result(zcr_score, hf_score, flux_score, dr_score, snr_score))
+    
+    return results
+
 def match_voice(live_audio_path, template_features_path):
     """
     Match live audio against stored template features
     
     Args:
         live_audio_path: Path to live recording
-        template_features_path: Path to stored template features (.npy)
+        template_features_path: Path to stored template features (.npy);
+            a file of K stacked templates (K, D) is matched in one pass and
+            the best-scoring template counts
+    
+    Returns:
+        dict: {
+            'match': bool,
+            'similarity': float (0-1)
+        }
+    """
+    return _match_features(extract_features(live_audio_path), template_features_path)
+
+def match_voice_from_array(audio, sample_rate, template_features_path):
+    """
+    Match an already loaded signal against stored template features
+    
+    Args:
+        audio: Mono float32 audio signal (normalized in place)
+        sample_rate: Sample rate in Hz
+        template_features_path: Path to stored template features
     
     Returns:
         dict: {
@@ -142,22 +418,33 @@ def match_voice(live_audio_path, template_features_path):
             'similarity': float (0-1)
         }
     """
+    return _match_features(
+        extract_features_from_array(audio, sample_rate), template_features_path
+    )
+
+def _match_features(live_features, template_features_path):
+    """Compare live features with the template, see match_voice"""
     try:
-        # Extract features from live audio
-        live_features = extract_features(live_audio_path)
+        # Load template features (cached)
+        template_features, template_norm = load_template(template_features_path)
         
-        # Load template features
-        template_features = np.load(template_features_path)
-        
-        # Compare features
-        similarity = compare_features(live_features, template_features)
+        if np.ndim(template_features) == 2:
+            # Score all enrolled templates at once and keep the best
+            similarities = compare_templates(live_features, template_features, template_norm)
+            similarity = float(similarities.max()) if len(similarities) else 0.0
+        else:
+            # Compare features (batched with concurrent authentications)
+            similarity = similarity_batcher.similarity(live_features, template_features, template_norm)
         
         match = similarity >= MATCH_THRESHOLD
         
-        print(f"🎯 Voice Match:")
-        print(f"  - Similarity: {similarity:.3f}")
-        print(f"  - Threshold: {MATCH_THRESHOLD}")
-        print(f"  → Result: {'MATCH' if match else 'NO MATCH'}")
+        logger.debug(
+            "🎯 Voice Match:\n"
+            "  - Similarity: %.3f\n"
+            "  - Threshold: %s\n"
+            "  → Result: %s",
+            similarity, MATCH_THRESHOLD, 'MATCH' if match else 'NO MATCH'
+        )
         
         return {
             'match': match,
@@ -165,7 +452,7 @@ def match_voice(live_audio_path, template_features_path):
         }
         
     except Exception as e:
-        print(f"❌ Error in voice matching: {e}")
+        logger.error("❌ Error in voice matching: %s", e)
         return {
             'match': False,
             'similarity': 0.0
@@ -187,16 +474,20 @@ def authenticate_voice(live_audio_path, template_features_path):
             'reason': str (if failed)
         }
     """
-    print("\n" + "="*60)
-    print("🎙️  VOICE AUTHENTICATION")
-    print("="*60)
-    
-    # Step 1: Spoof detection
-    print("\n[1/2] Checking for replay attacks...")
-    spoof_result = detect_spoof(live_audio_path)
+    # Step 1: Spoof detection (the recording is read once for both steps)
+    logger.debug("%s\n🎙️  VOICE AUTHENTICATION\n%s\n[1/2] Checking for replay attacks...", "=" * 60, "=" * 60)
+    try:
+        audio, sample_rate = _load_audio(live_audio_path)
+        spoof_result = detect_spoof_from_array(audio, sample_rate)
+    except Exception as e:
+        logger.error("❌ Error in spoof detection: %s", e)
+        spoof_result = {
+            'is_live': False,
+            'confidence': 0.0
+        }
     
     if not spoof_result['is_live']:
-        print("\n❌ AUTHENTICATION FAILED: Possible spoof detected")
+        logger.debug("❌ AUTHENTICATION FAILED: Possible spoof detected")
         return {
             'authenticated': False,
             'spoof_score': spoof_result['confidence'],
@@ -205,11 +496,11 @@ def authenticate_voice(live_audio_path, template_features_path):
         }
     
     # Step 2: Voice matching
-    print("\n[2/2] Matching voice against template...")
-    match_result = match_voice(live_audio_path, template_features_path)
+    logger.debug("[2/2] Matching voice against template...")
+    match_result = match_voice_from_array(audio, sample_rate, template_features_path)
     
     if not match_result['match']:
-        print("\n❌ AUTHENTICATION FAILED: Voice does not match")
+        logger.debug("❌ AUTHENTICATION FAILED: Voice does not match")
         return {
             'authenticated': False,
             'spoof_score': spoof_result['confidence'],
@@ -218,8 +509,7 @@ def authenticate_voice(live_audio_path, template_features_path):
         }
     
     # Both checks passed
-    print("\n✅ AUTHENTICATION SUCCESSFUL")
-    print("="*60)
+    logger.debug("✅ AUTHENTICATION SUCCESSFUL\n%s", "=" * 60)
     return {
         'authenticated': True,
         'spoof_score': spoof_result['confidence'],
@@ -231,6 +521,9 @@ if __name__ == "__main__":
     # Test the authentication
     import sys
     
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.DEBUG)
+    
     if len(sys.argv) >= 3:
         live_audio = sys.argv[1]
         template_features = sys.argv[2]